@@ -13,22 +13,34 @@
 """
 
 import argparse
-import base64
+import functools
+import hashlib
 import logging
 import mimetypes
+import mmap
 import os
 import re
+import secrets
+import textwrap
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from types import MappingProxyType
+from typing import Iterator, Mapping, Optional
+from urllib.parse import quote
 
 # 第三方库
-import markdown
+import mistune
+import pybase64
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
+from mistune.util import escape, safe_entity, striptags
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import TextLexer, get_lexer_by_name
+from pygments.util import ClassNotFound
 
-# New GenAI SDK
-from google import genai
-from google.genai import types
+# New GenAI SDK (google.genai 导入较慢，在 _get_client 等处按需导入)
 
 # 配置日志
 logging.basicConfig(
@@ -57,58 +69,140 @@ TEXT_MODEL_NAME = os.getenv("TEXT_MODEL_NAME", "gemini-3-pro-preview")
 IMAGE_RESOLUTION = os.getenv("IMAGE_RESOLUTION", "2k").lower()
 ENABLE_SEARCH = os.getenv("ENABLE_SEARCH", "false").lower() == "true"
 
-# Initialize Client
-client = None
-if GOOGLE_API_KEY:
-    try:
-        client = genai.Client(api_key=GOOGLE_API_KEY)
-    except Exception as e:
-        logger.error(f"GenAI Client 初始化失败: {e}")
-else:
-    logger.warning("未检测到 GOOGLE_API_KEY，图片生成功能将被跳过。")
+# 并发生成图片的最大线程数 (default: 8, 最小为 1)
+try:
+    IMAGE_WORKERS = max(1, int(os.getenv("IMAGE_WORKERS", "8")))
+except ValueError:
+    logger.warning(f"IMAGE_WORKERS 不是整数: {os.getenv('IMAGE_WORKERS')!r}，使用默认值 8")
+    IMAGE_WORKERS = 8
+
+# Prompt 扩展结果的磁盘缓存目录 (按 TEXT_MODEL_NAME + System Prompt + 描述 的 SHA-256 命名)
+# 留空视为未设置，支持 ~ 开头的路径
+PROMPT_CACHE_DIR = Path(
+    os.getenv("PROMPT_CACHE_DIR") or Path.home() / ".cache" / "wechat-gen" / "prompts"
+).expanduser()
+
+# GenAI Client (惰性初始化: 首次需要调用 Gemini 时才导入 SDK 并创建)
+_client_singleton = None
+_client_init = False
+_client_lock = threading.Lock()
+
+def _get_client():
+    """返回 GenAI Client；未配置 GOOGLE_API_KEY 或初始化失败时返回 None"""
+    global _client_singleton, _client_init
+    with _client_lock:
+        if not _client_init:
+            _client_init = True
+            if GOOGLE_API_KEY:
+                try:
+                    from google import genai
+                    _client_singleton = genai.Client(api_key=GOOGLE_API_KEY)
+                except Exception as e:
+                    logger.error(f"GenAI Client 初始化失败: {e}")
+            else:
+                logger.warning("未检测到 GOOGLE_API_KEY，图片生成功能将被跳过。")
+    return _client_singleton
+
+# Markdown Patterns (预编译)
+# 图片: ![alt](目标) - alt 为 Image 时是待生成占位符，否则为本地 / 远程图片
+# 目标允许一层成对括号，如 screenshot (1).png
+_IMAGE_RE = re.compile(r'!\[([^\]]*)\]\(([^()]*(?:\([^()]*\)[^()]*)*)\)')
+# 图片目标 = 地址原文 (可写成 <含空格的地址>) + 其余部分 (可选标题 "t" / 't' / (t) 及空白)
+_IMAGE_TARGET_RE = re.compile(r'^(\s*(<[^>]*>|.*?))(\s+(?:"[^"]*"|\'[^\']*\'|\([^)]*\))\s*|\s*)$', re.DOTALL)
+# 改写过的图片在 Markdown 中的短地址 #wechat-img-<每次运行的随机数>-N，渲染后再替换回真实地址
+# (不让上 MB 的 base64 进入解析器；随机数避免与原文冲突)
+_IMAGE_TOKEN_RE = re.compile(r'#wechat-img-[0-9a-f]{16}-\d+')
+_IMAGE_TOKEN_SRC_RE = re.compile(r'src="(#wechat-img-[0-9a-f]{16}-\d+)"( alt="[^"]*")?')
+# 一级标题: # 标题
+_TITLE_RE = re.compile(r'^#\s+(.+)$', re.MULTILINE)
+# 空段落: 只含空白 / &nbsp; / <br> 的 <p> (不匹配 <pre>)
+_EMPTY_P_RE = re.compile(r'<p(?:\s[^>]*)?>(?:\s|&nbsp;|<br\s*/?>)*</p>')
 
 # ============================================
 # Image Generation Module
 # ============================================
 
+# 针对文章插图优化的 System Prompt (去除缩进与首尾空白，减少每次请求的 token)
+_SYS_PROMPT = textwrap.dedent("""
+    你是一个专业的 AI 绘画提示词专家。请根据以下简单的画面描述，扩写成一段详细的英文绘图 Prompt。
+    要求:
+    1. 风格: 现代极简主义插画，平面风格，柔和暖色调(Morandi colors)，适合微信公众号配图。
+    2. 画面: 构图简洁，留白适度，避免过于复杂的细节。
+    3. 仅输出英文 Prompt，不要包含其他解释。
+""").strip()
+# 修改 System Prompt 后旧的扩展结果随之失效
+_SYS_PROMPT_HASH = hashlib.sha256(_SYS_PROMPT.encode("utf-8")).hexdigest()[:16]
+
+# 本次运行内已成功扩展的 Prompt (只缓存成功结果，失败的描述下次仍会重试)
+_expanded_prompts: dict = {}
+_expanded_prompts_lock = threading.Lock()
+
 def expand_prompt(description: str) -> str:
-    """使用 LLM 将简短描述扩展为详细的绘图 Prompt"""
+    """使用 LLM 将简短描述扩展为详细的绘图 Prompt (成功结果缓存于内存与 PROMPT_CACHE_DIR)"""
+    client = _get_client()
     if not client:
         return description
 
+    with _expanded_prompts_lock:
+        expanded = _expanded_prompts.get(description)
+    if expanded is not None:
+        return expanded
+
+    key = hashlib.sha256(f"{TEXT_MODEL_NAME}:{_SYS_PROMPT_HASH}:{description}".encode("utf-8")).hexdigest()
+    cache_path = PROMPT_CACHE_DIR / f"{key}.txt"
     try:
-        # 针对文章插图优化的 System Prompt
-        sys_prompt = """
-        你是一个专业的 AI 绘画提示词专家。请根据以下简单的画面描述，扩写成一段详细的英文绘图 Prompt。
-        要求:
-        1. 风格: 现代极简主义插画，平面风格，柔和暖色调(Morandi colors)，适合微信公众号配图。
-        2. 画面: 构图简洁，留白适度，避免过于复杂的细节。
-        3. 仅输出英文 Prompt，不要包含其他解释。
-        """
+        expanded = cache_path.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        expanded = ""
+    except (OSError, UnicodeDecodeError) as e:
+        # 损坏 / 无法读取的缓存文件视为未命中
+        logger.warning(f"Prompt 缓存读取失败，重新生成: {e}")
+        expanded = ""
+    if expanded:
+        logger.info(f"Prompt 命中缓存: '{description}' -> '{expanded[:50]}...'")
+        with _expanded_prompts_lock:
+            _expanded_prompts[description] = expanded
+        return expanded
+
+    try:
+        from google.genai import types
         
+        # System Prompt 作为 system_instruction 单独下发，contents 只包含描述本身
         response = client.models.generate_content(
             model=TEXT_MODEL_NAME,
-            contents=f"{sys_prompt}\n\n原始描述: {description}"
+            contents=f"原始描述: {description}",
+            config=types.GenerateContentConfig(system_instruction=_SYS_PROMPT)
         )
         
         expanded = response.text.strip()
         logger.info(f"Prompt 优化: '{description}' -> '{expanded[:50]}...'")
-        return expanded
     except Exception as e:
         logger.error(f"Prompt 扩展失败: {e}")
         return description
 
-def generate_image_from_prompt(prompt: str, output_path: Path) -> bool:
+    with _expanded_prompts_lock:
+        _expanded_prompts[description] = expanded
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(expanded, encoding="utf-8")
+    except OSError as e:
+        logger.warning(f"Prompt 缓存写入失败: {e}")
+    return expanded
+
+def generate_image_from_prompt(prompt: str) -> tuple[bool, Optional[bytes], Optional[str]]:
     """
-    调用 Gemini 生成图片
+    调用 Gemini 生成图片，返回 (是否成功, 图片数据, MIME 类型)
     配置从环境变量读取:
         IMAGE_RESOLUTION: '1k', '2k', '4k'
         ENABLE_SEARCH: 是否开启 Google Search Grounding
     """
+    client = _get_client()
     if not client:
-        return False
+        return False, None, None
 
     try:
+        from google.genai import types
+        
         logger.info(f"正在调用 {IMG_MODEL_NAME} 生成图片 (Res: {IMAGE_RESOLUTION}, Search: {ENABLE_SEARCH})...")
         
         # 1. 配置分辨率 (currently unused per user's correction, kept for reference)
@@ -141,175 +235,233 @@ def generate_image_from_prompt(prompt: str, output_path: Path) -> bool:
         if response.candidates and response.candidates[0].content.parts:
             for part in response.candidates[0].content.parts:
                 if part.inline_data:
-                    output_path.write_bytes(part.inline_data.data)
-                    logger.info(f"图片已保存: {output_path}")
-                    return True
+                    mime_type = part.inline_data.mime_type or "image/png"
+                    return True, part.inline_data.data, mime_type
         
         logger.error("Gemini 生成响应中没有图片数据")
-        return False
+        return False, None, None
 
     except Exception as e:
         logger.error(f"图片生成 API 错误: {e}")
-        return False
+        return False, None, None
+
+def _image_bytes_to_data_uri(data, mime_type: str) -> str:
+    """将图片数据 (bytes / mmap) 编码为 base64 data URI"""
+    return "".join(("data:", mime_type, ";base64,", pybase64.b64encode_as_string(data)))
+
+
+@functools.lru_cache(maxsize=None)
+def _mime_for_suffix(suffix: str) -> str:
+    """按扩展名查询 MIME 类型 (缓存，同类图片只查一次 mimetypes 表)"""
+    mime_type, _ = mimetypes.guess_type(f"image{suffix}")
+    return mime_type or "image/png"
+
 
 def image_to_base64(image_path: Path) -> str:
     """将图片文件转换为 base64 data URI"""
-    mime_type, _ = mimetypes.guess_type(str(image_path))
-    if not mime_type:
-        mime_type = "image/png"
+    mime_type = _mime_for_suffix(image_path.suffix.lower())
     
     with open(image_path, "rb") as f:
-        b64_data = base64.b64encode(f.read()).decode("utf-8")
-    
-    return f"data:{mime_type};base64,{b64_data}"
+        # 空文件无法 mmap
+        if os.fstat(f.fileno()).st_size == 0:
+            return _image_bytes_to_data_uri(b"", mime_type)
+        # mmap 直接交给 pybase64 编码为 str，避免 read() 和 bytes → str 的额外拷贝
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _image_bytes_to_data_uri(mm, mime_type)
 
 
-def process_images(content: str, assets_dir: Path) -> str:
+def generate_image(desc: str, full_prompt: str, assets_dir: Optional[Path], index: int = 0) -> Optional[str]:
     """
-    扫描 Markdown 中的图片占位符 `![Image](描述)`
-    配置从环境变量读取 (IMAGE_RESOLUTION, ENABLE_SEARCH)
+    为占位符 `![Image](描述)` 按已扩展的 full_prompt 生成配图，返回 base64 data URI (失败时返回 None)
+    图片直接在内存中转为 base64；指定 assets_dir 时另存一份到磁盘
     """
-    pattern = r'!\[Image\]\((.*?)\)'
-    
-    matches = re.finditer(pattern, content, re.IGNORECASE)
+    logger.info(f"发现待生成图片: {desc}")
     
-    replacements = []
+    # 2. 调用生成 (使用全局配置)
+    success, data, mime_type = generate_image_from_prompt(prompt=full_prompt)
     
-    for match in matches:
-        desc = match.group(1)
-        logger.info(f"发现待生成图片: {desc}")
-        
-        # 1. 扩展 Prompt (Gemini 3 Pro Text)
-        full_prompt = expand_prompt(desc)
-        
-        # 2. 生成图片
-        timestamp = int(time.time() * 1000)
-        img_filename = f"gen_{timestamp}.png"
-        img_path = assets_dir / img_filename
-        
-        # 3. 调用生成 (使用全局配置)
-        success = generate_image_from_prompt(
-            prompt=full_prompt, 
-            output_path=img_path
-        )
+    if success:
+        # 3. 可选: 保存到 assets 目录
+        if assets_dir is not None:
+            # 并发生成时时间戳可能相同，附加图片序号避免文件名冲突
+            timestamp = int(time.time() * 1000)
+            ext = mimetypes.guess_extension(mime_type) or ".png"
+            img_path = assets_dir / f"gen_{timestamp}_{index}{ext}"
+            try:
+                img_path.write_bytes(data)
+                logger.info(f"图片已保存: {img_path}")
+            except OSError as e:
+                # 保存只是附带功能，失败不影响内嵌
+                logger.warning(f"图片保存失败: {e}")
         
-        if success:
-            b64_uri = image_to_base64(img_path)
-            replacements.append((match.span(), f"![{desc}]({b64_uri})"))
-            logger.info(f"图片已转换为 base64: {desc[:30]}...")
-        else:
-            logger.warning(f"图片生成跳过: {desc}")
-            replacements.append((match.span(), f"![{desc}](https://placehold.co/800x400/FFF9E6/FF9E66.png?text={desc})"))
-
-    new_content = list(content) 
-    for (start, end), replacement in reversed(replacements):
-        new_content[start:end] = list(replacement)
+        b64_uri = _image_bytes_to_data_uri(data, mime_type)
+        logger.info(f"图片已转换为 base64: {desc[:30]}...")
+        return b64_uri
+    
+    logger.warning(f"图片生成跳过: {desc}")
+    return None
+
+
+def embed_image(url: str, base_dir: Path) -> Optional[str]:
+    """将本地图片内嵌为 base64 data URI (data: / http(s) / 缺失文件返回 None，保持原样)"""
+    if url.startswith(("data:", "http://", "https://")):
+        return None
+    
+    # 解析图片路径（相对于 Markdown 文件所在目录）
+    img_path = base_dir / url
     
-    return "".join(new_content)
+    if img_path.is_file():
+        logger.info(f"内嵌本地图片: {img_path}")
+        return image_to_base64(img_path)
+    
+    logger.warning(f"图片文件不存在，跳过: {img_path}")
+    return None
 
 
-def embed_local_images(content: str, base_dir: Path) -> str:
+def split_image_target(target: str) -> tuple[str, str, str]:
     """
-    扫描 Markdown 中已有的本地图片路径 `![alt](path/to/image.png)`
-    将其转换为 base64 内嵌格式
+    拆分图片目标为 (地址原文, 地址, 其余部分)
+    地址原文 + 其余部分 == target；地址去掉首尾空白与 <...> 包裹
     """
-    # 正则匹配: ![任意alt](本地路径) - 排除已经是 data: 或 http 的
-    pattern = r'!\[([^\]]*)\]\((?!data:|https?://)([^)]+)\)'
-    
-    matches = list(re.finditer(pattern, content))
+    match = _IMAGE_TARGET_RE.match(target)
+    raw, url, rest = match.groups()
+    if url.startswith("<") and url.endswith(">"):
+        url = url[1:-1]
+    return raw, url, rest
+
+
+def process_images(content: str, assets_dir: Optional[Path], base_dir: Path) -> tuple[str, list]:
+    """
+    单次扫描 Markdown 中的全部图片 `![alt](目标)`:
+    1. 占位符 `![Image](描述)` -> 调用 Gemini 生成配图 (最多 IMAGE_WORKERS 张并发)
+       配置从环境变量读取 (IMAGE_RESOLUTION, ENABLE_SEARCH)
+       assets_dir 为 None 时不落盘
+    2. 本地图片 `![alt](path/to/image.png)` -> 转换为 base64 内嵌格式
+    3. data: / http(s) 图片保持原样
+    返回 (Markdown, images)：改写过的图片地址在 Markdown 中写作短地址，
+    images 为 {短地址: (src, alt 或 None, 地址原文)}，由 markdown_to_html 在渲染后还原
+    无需改写的图片原样保留
+    """
+    matches = list(_IMAGE_RE.finditer(content))
+    images = {}
     
     if not matches:
-        return content
+        return content, images
+    
+    nonce = secrets.token_hex(8)
     
-    replacements = []
+    def image_ref(alt_text: str, raw: str, src: str, alt: Optional[str] = None, rest: str = "") -> str:
+        token = f"#wechat-img-{nonce}-{len(images)}"
+        images[token] = (src, alt, raw)
+        return f"![{alt_text}]({token}{rest})"
     
-    for match in matches:
-        alt_text = match.group(1)
-        img_path_str = match.group(2)
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as executor:
+        # 1. 扩展 Prompt (Gemini 3 Pro Text)
+        # 相同描述只扩展一次: 重复的占位符若同时提交，会在缓存写入前各自调用一次文本模型
+        expansions = {}
+        for match in matches:
+            desc = match.group(2)
+            if match.group(1).lower() == "image" and desc not in expansions:
+                expansions[desc] = executor.submit(expand_prompt, desc)
         
-        # 解析图片路径（相对于 Markdown 文件所在目录）
-        img_path = base_dir / img_path_str
+        # 2. 每张图只等待自己描述的扩展，随即生成，不等其余描述全部扩展完
+        # 扩展任务全部先于生成任务入队 (线程池按 FIFO 取任务)，生成任务开始时其扩展已在运行或已完成，不会死锁
+        def expand_then_generate(desc: str, index: int) -> Optional[str]:
+            return generate_image(desc, expansions[desc].result(), assets_dir, index)
         
-        if img_path.exists():
-            logger.info(f"内嵌本地图片: {img_path}")
-            b64_uri = image_to_base64(img_path)
-            replacements.append((match.span(), f"![{alt_text}]({b64_uri})"))
-        else:
-            logger.warning(f"图片文件不存在，跳过: {img_path}")
-    
-    # 倒序替换
-    new_content = list(content)
-    for (start, end), replacement in reversed(replacements):
-        new_content[start:end] = list(replacement)
+        futures = {
+            i: executor.submit(expand_then_generate, match.group(2), i)
+            for i, match in enumerate(matches)
+            if match.group(1).lower() == "image"
+        }
+        
+        # 3. 按原文顺序拼接 (本地图片在等待生成期间于主线程内嵌)
+        parts = []
+        pos = 0
+        for i, match in enumerate(matches):
+            start, end = match.span()
+            parts.append(content[pos:start])
+            alt_text, target = match.groups()
+            if i in futures:
+                # 生成的图片以描述作为 alt
+                src = futures[i].result() or f"https://placehold.co/800x400/FFF9E6/FF9E66.png?text={quote(target)}"
+                parts.append(image_ref(alt_text, target, src, alt=escape(target)))
+            else:
+                raw, url, rest = split_image_target(target)
+                uri = embed_image(url, base_dir)
+                if uri:
+                    parts.append(image_ref(alt_text, raw, uri, rest=rest))
+                elif any(c.isspace() for c in url) and raw.strip() == url:
+                    # CommonMark 地址不允许裸空白 (如 my pic.png)，改由短地址承载
+                    parts.append(image_ref(alt_text, raw, _markdown.renderer.safe_url(url), rest=rest))
+                else:
+                    parts.append(content[start:end])
+            pos = end
+        parts.append(content[pos:])
     
-    return "".join(new_content)
+    return "".join(parts), images
 
 
 # ============================================
 # CSS Inlining Module (New)
 # ============================================
 
-def get_style_mapping() -> dict:
-    """
-    Define inline styles based on wechat_style.css
-    Since simple parsing is error-prone without heavy deps, we hardcode key mappings here
-    matching the known template.
-    """
-    return {
-        "body": "font-family: -apple-system, BlinkMacSystemFont, 'PingFang SC', 'Hiragino Sans GB', 'Microsoft YaHei', sans-serif; line-height: 1.75; color: #333333; background: #FAF9F5; margin: 0; padding: 0;",
-        "h1": "font-size: 1.6rem; font-weight: 700; color: #222; margin-bottom: 24px; line-height: 1.4;",
-        "h2": "display: inline-block; background: #E9C4B1; color: #222; font-size: 1.15rem; padding: 4px 16px; border-radius: 20px; margin: 40px 0 20px; font-weight: 600; box-shadow: 2px 2px 0px rgba(0, 0, 0, 0.05);",
-        "h3": "font-size: 1.05rem; font-weight: 600; color: #333333; margin: 28px 0 12px; border-left: 4px solid #FF9E66; padding-left: 10px; line-height: 1.2;",
-        "p": "margin-bottom: 20px; text-align: justify; letter-spacing: 0.03em; font-size: 1rem;",
-        "strong": "color: #D35400; background: linear-gradient(180deg, transparent 65%, rgba(255, 158, 102, 0.2) 65%); padding: 0 2px;",
-        "blockquote": "background: #FFF9E6; border-left: 4px solid #FF9E66; border-radius: 12px; padding: 16px 20px; margin: 24px 0; color: #5F5F5F; font-size: 0.95rem;",
-        "ul": "padding-left: 20px; margin-bottom: 24px; color: #5F5F5F;",
-        "ol": "padding-left: 20px; margin-bottom: 24px; color: #5F5F5F;",
-        "li": "margin-bottom: 8px;",
-        "pre": "background: #282C34; border-radius: 12px; padding: 40px 20px 20px; position: relative; overflow-x: auto; margin: 24px 0; color: #ABB2BF; font-size: 0.85rem; line-height: 1.6;",
-        "code": "font-family: 'Fira Code', Consolas, monospace;",
-        "img": "display: block; max-width: 100%; border-radius: 12px; margin: 24px auto; box-shadow: 0 4px 12px rgba(0, 0, 0, 0.08);",
-        "hr": "border: 0; height: 1px; background: #E0E0E0; margin: 40px 60px;",
-        "article_container": "max-width: 680px; margin: 0 auto; background: #FAF9F5; min-height: 100vh;",
-        "article_content": "padding: 24px 20px 60px; background: #FAF9F5;"
-    }
-
-def apply_inline_styles(soup: BeautifulSoup) -> None:
-    """Apply inline styles to elements based on the mapping"""
-    styles = get_style_mapping()
-    
-    # 1. Apply tag-based styles
-    for tag in styles:
-        if tag in ["body", "article_container", "article_content"]: continue
-        
-        for element in soup.find_all(tag):
-            # Prepend existing style if any, but usually we just append or merge
-            # Simple merge: new style + old style
-            current_style = element.get('style', '')
-            new_style = styles[tag]
-            # If element has style, we append the template style BEFORE it so element specific style overrides? 
-            # Or usually template first.
-            # Strategy: Set template style, then append what was there (if specifically manually set).
-            # But wait, soup.find_all might return elements we already touched? No.
-            
-            # Special case: Inline code vs Block code
-            if tag == "code":
-                if element.parent.name == "pre": continue # Handled by pre stlying mostly
-                # Inline code styling
-                inline_code_style = "background: #F0EEE6; color: #C04848; padding: 2px 6px; border-radius: 4px; font-size: 0.9em;"
-                element['style'] = inline_code_style + current_style
-                continue
-
-            element['style'] = new_style + " " + current_style
-
-    # 2. Special Classes (First P)
-    # .article-content > p:first-of-type
-    # This is hard to select exactly with simple loops, lets look for the first p in article content
-    # Assuming article content wrapper is not yet there in 'soup' passed here? 
-    # Usually we process the BODY HTML fragment.
-    
-    first_p = soup.find("p")
-    if first_p:
+# Define inline styles based on wechat_style.css
+# Since simple parsing is error-prone without heavy deps, we hardcode key mappings here
+# matching the known template. Built once at import and exposed read-only.
+_STYLE_MAP = MappingProxyType({
+    "body": "font-family: -apple-system, BlinkMacSystemFont, 'PingFang SC', 'Hiragino Sans GB', 'Microsoft YaHei', sans-serif; line-height: 1.75; color: #333333; background: #FAF9F5; margin: 0; padding: 0;",
+    "h1": "font-size: 1.6rem; font-weight: 700; color: #222; margin-bottom: 24px; line-height: 1.4;",
+    "h2": "display: inline-block; background: #E9C4B1; color: #222; font-size: 1.15rem; padding: 4px 16px; border-radius: 20px; margin: 40px 0 20px; font-weight: 600; box-shadow: 2px 2px 0px rgba(0, 0, 0, 0.05);",
+    "h3": "font-size: 1.05rem; font-weight: 600; color: #333333; margin: 28px 0 12px; border-left: 4px solid #FF9E66; padding-left: 10px; line-height: 1.2;",
+    "p": "margin-bottom: 20px; text-align: justify; letter-spacing: 0.03em; font-size: 1rem;",
+    "strong": "color: #D35400; background: linear-gradient(180deg, transparent 65%, rgba(255, 158, 102, 0.2) 65%); padding: 0 2px;",
+    "blockquote": "background: #FFF9E6; border-left: 4px solid #FF9E66; border-radius: 12px; padding: 16px 20px; margin: 24px 0; color: #5F5F5F; font-size: 0.95rem;",
+    "ul": "padding-left: 20px; margin-bottom: 24px; color: #5F5F5F;",
+    "ol": "padding-left: 20px; margin-bottom: 24px; color: #5F5F5F;",
+    "li": "margin-bottom: 8px;",
+    "pre": "background: #282C34; border-radius: 12px; padding: 40px 20px 20px; position: relative; overflow-x: auto; margin: 24px 0; color: #ABB2BF; font-size: 0.85rem; line-height: 1.6;",
+    "code": "font-family: 'Fira Code', Consolas, monospace;",
+    "img": "display: block; max-width: 100%; border-radius: 12px; margin: 24px auto; box-shadow: 0 4px 12px rgba(0, 0, 0, 0.08);",
+    "hr": "border: 0; height: 1px; background: #E0E0E0; margin: 40px 60px;",
+    "article_container": "max-width: 680px; margin: 0 auto; background: #FAF9F5; min-height: 100vh;",
+    "article_content": "padding: 24px 20px 60px; background: #FAF9F5;"
+})
+
+def get_style_mapping() -> Mapping[str, str]:
+    """Return the (read-only) tag -> inline style mapping"""
+    return _STYLE_MAP
+
+
+# 代码块高亮: 输出结构与原 codehilite 一致 (<div class="codehilite"><pre style="..."><code>)
+_CODE_FORMATTER = HtmlFormatter(cssclass="codehilite", wrapcode=True, prestyles=_STYLE_MAP["pre"])
+
+@functools.lru_cache(maxsize=64)
+def _get_lexer(lang: str):
+    """按语言名获取 Pygments Lexer (缓存，避免每个代码块重复查找)"""
+    try:
+        return get_lexer_by_name(lang)
+    except ClassNotFound:
+        return TextLexer()
+
+
+class WeChatRenderer(mistune.HTMLRenderer):
+    """Apply inline styles to elements based on the mapping, while mistune renders the HTML"""
+
+    def __call__(self, tokens, state) -> str:
+        # Special Classes (First P)
+        # .article-content > p:first-of-type -- top-level tokens are exactly the article content
+        out = []
+        first_p_pending = True
+        for tok in tokens:
+            if first_p_pending and tok["type"] == "paragraph":
+                first_p_pending = False
+                out.append(self.first_paragraph(self.render_tokens(tok["children"], state)))
+            else:
+                out.append(self.render_token(tok, state))
+        return "".join(out)
+
+    def first_paragraph(self, text: str) -> str:
         first_p_style = "background: #FFF; border: 1px solid #EAEAEA; padding: 24px; border-radius: 12px; font-size: 1.05rem; color: #444; box-shadow: 0 8px 16px rgba(0, 0, 0, 0.04); position: relative; overflow: hidden;"
         # Pseudo-elements like ::before cannot be inlined directly into style="" attribute.
         # We simulate the top bar with a real div if we want, or just accept basic styling.
@@ -317,39 +469,97 @@ def apply_inline_styles(soup: BeautifulSoup) -> None:
         # For simplicity, we skip the pseudo-element 'top bar' in inline logic or add a border-top.
         # Let's add border-top as approximation
         first_p_style += " border-top: 4px solid #FF9E66;" 
-        
-        current_style = first_p.get('style', '')
-        first_p['style'] = first_p_style + " " + current_style
+        return f'<p style="{first_p_style} {_STYLE_MAP["p"]} ">{text}</p>\n'
+
+    def paragraph(self, text: str) -> str:
+        return f'<p style="{_STYLE_MAP["p"]} ">{text}</p>\n'
+
+    def heading(self, text: str, level: int, **attrs) -> str:
+        tag = f"h{level}"
+        if tag not in _STYLE_MAP:
+            return super().heading(text, level, **attrs)
+        return f'<{tag} style="{_STYLE_MAP[tag]} ">{text}</{tag}>\n'
+
+    def strong(self, text: str) -> str:
+        return f'<strong style="{_STYLE_MAP["strong"]} ">{text}</strong>'
+
+    def codespan(self, text: str) -> str:
+        # Inline code styling (block code is handled by pre styling)
+        inline_code_style = "background: #F0EEE6; color: #C04848; padding: 2px 6px; border-radius: 4px; font-size: 0.9em;"
+        return f'<code style="{inline_code_style}">{escape(text)}</code>'
+
+    def image(self, text: str, url: str, title: Optional[str] = None) -> str:
+        html = f'<img src="{self.safe_url(url)}" alt="{striptags(text)}"'
+        if title:
+            html += f' title="{safe_entity(title)}"'
+        return f'{html} style="{_STYLE_MAP["img"]} " />'
+
+    def thematic_break(self) -> str:
+        return f'<hr style="{_STYLE_MAP["hr"]} " />\n'
+
+    def block_code(self, code: str, info: Optional[str] = None) -> str:
+        lang = info.split(None, 1)[0] if info and info.strip() else "text"
+        return highlight(code, _get_lexer(lang), _CODE_FORMATTER)
+
+    def block_quote(self, text: str) -> str:
+        return f'<blockquote style="{_STYLE_MAP["blockquote"]} ">\n{text}</blockquote>\n'
+
+    def list(self, text: str, ordered: bool, **attrs) -> str:
+        tag = "ol" if ordered else "ul"
+        start = attrs.get("start")
+        start_attr = f' start="{start}"' if ordered and start is not None else ""
+        return f'<{tag}{start_attr} style="{_STYLE_MAP[tag]} ">\n{text}</{tag}>\n'
+
+    def list_item(self, text: str) -> str:
+        return f'<li style="{_STYLE_MAP["li"]} ">{text}</li>\n'
+
+
+# 渲染器无状态，进程内复用同一个 Markdown 实例
+# 原文中手写的 data URI 只放行图片 (bmp / avif / tiff / ico / svg 等都不在 mistune 默认白名单内)
+_markdown = mistune.create_markdown(
+    renderer=WeChatRenderer(escape=False, allow_harmful_protocols=("data:image/",)),
+    plugins=["table", "strikethrough", "footnotes", "task_lists", "def_list", "abbr"],
+)
 
 
 # ============================================
 # CSS & HTML Module
 # ============================================
 
+@functools.lru_cache(maxsize=1)
 def load_css() -> str:
-    """加载 CSS"""
+    """加载 CSS (进程内只读取一次)"""
     css_path = Path(__file__).parent.parent / "templates" / "wechat_style.css"
     if css_path.exists():
         return css_path.read_text(encoding="utf-8")
     return "" 
 
 
-def markdown_to_html(content: str) -> str:
-    """Markdown 转 Body HTML"""
-    extensions = [
-        "markdown.extensions.extra",
-        "markdown.extensions.codehilite",
-        "markdown.extensions.toc",
-        "markdown.extensions.tables",
-    ]
-    return markdown.markdown(content, extensions=extensions)
+def markdown_to_html(content: str, images: Optional[Mapping[str, tuple]] = None) -> str:
+    """
+    Markdown 转 Body HTML (渲染时直接写入内联样式)
+    再按 process_images 返回的 images 还原短地址: <img src> 中的换成真实地址，
+    其余位置 (如代码中的图片语法) 换回地址原文
+    """
+    html = _markdown(content)
+    if not images:
+        return html
+    
+    def restore_src(m: re.Match) -> str:
+        if m.group(1) not in images:
+            return m.group(0)
+        src, alt, _ = images[m.group(1)]
+        return f'src="{src}"' + (f' alt="{alt}"' if alt is not None else m.group(2) or "")
+    
+    def restore_text(m: re.Match) -> str:
+        return escape(images[m.group(0)][2]) if m.group(0) in images else m.group(0)
+    
+    html = _IMAGE_TOKEN_SRC_RE.sub(restore_src, html)
+    return _IMAGE_TOKEN_RE.sub(restore_text, html)
 
 
-def build_full_html(body: str, title: str) -> str:
-    css = load_css()
-    
-    # 一键复制按钮样式
-    copy_btn_css = """
+# 一键复制按钮样式
+_COPY_BTN_CSS = """
 /* 一键复制按钮样式 */
 .copy-btn {
   position: fixed;
@@ -414,9 +624,9 @@ def build_full_html(body: str, title: str) -> str:
   .copy-btn, .copy-toast { display: none !important; }
 }
 """
-    
-    # 一键复制 JavaScript
-    copy_script = """
+
+# 一键复制 JavaScript
+_COPY_SCRIPT = """
 <script>
 function copyArticleContent() {
   // Select the container so that we capture the inner div with its background style
@@ -459,9 +669,9 @@ function copyArticleContent() {
 }
 </script>
 """
-    
-    # 复制按钮 HTML
-    copy_btn_html = """
+
+# 复制按钮 HTML
+_COPY_BTN_HTML = """
 <!-- 一键复制按钮 -->
 <button class="copy-btn" onclick="copyArticleContent()">
   <svg viewBox="0 0 24 24" xmlns="http://www.w3.org/2000/svg">
@@ -471,33 +681,54 @@ function copyArticleContent() {
 </button>
 <div class="copy-toast" id="copyToast">复制成功！可直接粘贴到微信公众号</div>
 """
-    
-    template = f"""<!DOCTYPE html>
-<html lang="zh-CN">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <meta name="generator" content="WeChat Article Gen (TechFastFood)">
-    <title>{title}</title>
-    <style>
-{css}
-{copy_btn_css}
+
+
+@functools.lru_cache(maxsize=1)
+def _head_styles() -> str:
+    """<style> 内容: 模板 CSS + 复制按钮样式，首次调用时拼接"""
+    return f"{load_css()}\n{_COPY_BTN_CSS}"
+
+
+# 正文前后的固定 HTML (wrapper 开合标签)
+_BODY_OPEN = f"""
     </style>
 </head>
 <body>
-{copy_btn_html}
-{copy_script}
+{_COPY_BTN_HTML}
+{_COPY_SCRIPT}
     <!-- WeChat Outer Wrapper to Enforce Background -->
     <section id="wechat-wrapper" style="background-color: #FAF9F5; min-height: 100vh; font-family: -apple-system, BlinkMacSystemFont, 'PingFang SC', 'Hiragino Sans GB', 'Microsoft YaHei', sans-serif; color: #333333; line-height: 1.75;">
         <div class="article-container" style="max-width: 680px; margin: 0 auto; background: #FAF9F5;">
             <div class="article-content" style="padding: 24px 20px 60px; background: #FAF9F5;">
-{body}
+"""
+
+_BODY_CLOSE = """
             </div>
         </div>
     </section>
 </body>
 </html>"""
-    return template
+
+
+def build_full_html_iter(body: str, title: str) -> Iterator[str]:
+    """按顺序产出完整 HTML 的各个片段 (head / css / wrapper 开始 / 正文 / wrapper 结束)，便于流式写入"""
+    yield f"""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <meta name="generator" content="WeChat Article Gen (TechFastFood)">
+    <title>{title}</title>
+    <style>
+"""
+    yield _head_styles()
+    yield _BODY_OPEN
+    yield body
+    yield _BODY_CLOSE
+
+
+def build_full_html(body: str, title: str) -> str:
+    return "".join(build_full_html_iter(body, title))
 
 
 # ============================================
@@ -506,24 +737,15 @@ function copyArticleContent() {
 
 def calibrate_code(html_content: str) -> str:
     """
-    代码校准功能
-    1. 清理空标签
-    2. 修复可能的未闭合标签 (通过 soup)
-    3. 移除冗余换行
+    代码校准功能 (内联样式已在 markdown_to_html 中写入)
+    1. 清理空的 p 标签 (单个预编译正则，无需解析 HTML)
     """
-    logger.info("执行代码校准与样式内联...")
-    
-    soup = BeautifulSoup(html_content, "html.parser")
+    logger.info("执行代码校准...")
     
-    # NEW: Phase 4.1 Apply Inline Styles
-    apply_inline_styles(soup)
+    if "<p" not in html_content:
+        return html_content
     
-    # 移除空的 p 标签
-    for p in soup.find_all("p"):
-        if not p.get_text(strip=True) and not p.find("img"):
-            p.decompose()
-            
-    return str(soup)
+    return _EMPTY_P_RE.sub("", html_content)
 
 
 # ============================================
@@ -535,6 +757,7 @@ def main():
     parser.add_argument("input", type=Path, help="Input Markdown file")
     parser.add_argument("-o", "--output", type=Path, help="Output HTML file")
     parser.add_argument("--preview", action="store_true", help="Browser preview")
+    parser.add_argument("--save-assets", action="store_true", help="Also save generated images to ./assets")
     args = parser.parse_args()
 
     if not args.input.exists():
@@ -544,29 +767,30 @@ def main():
     # 1. 读取内容
     content = args.input.read_text(encoding="utf-8")
     # 简单的标题提取逻辑
-    title_match = re.search(r'^#\s+(.+)$', content, re.MULTILINE)
+    title_match = _TITLE_RE.search(content)
     title = title_match.group(1) if title_match else "科技速食科普"
     
     # 2. 处理图片 (Phase 1.5) - 配置从 .env 读取
     logger.info(f"图片生成配置: Resolution={IMAGE_RESOLUTION}, Search={ENABLE_SEARCH}")
-    assets_dir = args.input.parent / "assets"
-    assets_dir.mkdir(exist_ok=True)
-    
-    content_with_images = process_images(content, assets_dir)
+    assets_dir = None
+    if args.save_assets:
+        assets_dir = args.input.parent / "assets"
+        assets_dir.mkdir(exist_ok=True)
     
-    # 2.5 内嵌本地图片为 base64
-    content_with_embedded = embed_local_images(content_with_images, args.input.parent)
+    # 生成占位符配图 + 内嵌本地图片为 base64 (单次扫描)
+    content_with_images, images = process_images(content, assets_dir, args.input.parent)
     
     # 3. 转换为 HTML (Phase 2)
-    body_html = markdown_to_html(content_with_embedded)
-    full_html = build_full_html(body_html, title)
+    body_html = markdown_to_html(content_with_images, images)
     
-    # 4. 代码校准 (Final Polish)
-    final_html = calibrate_code(full_html)
+    # 4. 代码校准 (Final Polish) - 模板部分是固定的，只需校准正文
+    body_html = calibrate_code(body_html)
     
-    # 5. 保存
+    # 5. 保存 (逐段流式写入，不再拼接完整 HTML 字符串)
     output_path = args.output or args.input.with_suffix(".html")
-    output_path.write_text(final_html, encoding="utf-8")
+    with output_path.open("w", encoding="utf-8", buffering=1 << 16) as f:
+        for chunk in build_full_html_iter(body_html, title):
+            f.write(chunk)
     
     logger.info(f"HTML 已生成: {output_path}")
     